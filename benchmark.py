@@ -0,0 +1,364 @@
+"""
+Offline throughput/latency benchmark for the judge.
+
+Starts a local stand-in for the OpenAI-compatible `/chat/completions` endpoint
+with configurable latency, 429/5xx injection and deterministic answers, then
+runs `main.judge_completions` or `run_submission.async_process_dataset` against
+it for every combination of concurrency level and dataset size.
+
+    python benchmark.py --concurrency 1 8 32 --sizes 40 200
+    python benchmark.py --output bench.json
+    python benchmark.py --baseline bench.json --tolerance 0.1
+"""
+import os
+
+# The verdict cache would turn repeated rows into hits and skew the numbers
+os.environ["JUDGE_CACHE_PATH"] = ""
+# main.py builds its client at import time; every run uses the mock server
+os.environ.setdefault("OPENROUTER_API_KEY", "mock")
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import cycle, islice
+
+from openai import AsyncOpenAI
+
+import main
+import run_submission
+
+
+class MockConfig:
+    def __init__(
+        self,
+        latency_median_ms: float = 300.0,
+        latency_sigma: float = 0.5,
+        rate_limit_ratio: float = 0.0,
+        server_error_ratio: float = 0.0,
+        invalid_ratio: float = 0.0,
+        max_inflight: int = 0,
+        retry_after: float = 1.0,
+        seed: int = 0,
+    ):
+        self.latency_median_ms = latency_median_ms
+        self.latency_sigma = latency_sigma
+        self.rate_limit_ratio = rate_limit_ratio
+        self.server_error_ratio = server_error_ratio
+        self.invalid_ratio = invalid_ratio
+        self.max_inflight = max_inflight
+        self.retry_after = retry_after
+        self.seed = seed
+
+
+class MockServer:
+    """
+    Threaded HTTP server answering `/chat/completions` requests.
+
+    Answers are derived from a hash of the user message, so the same request
+    always gets the same verdict. Latency is drawn from a lognormal
+    distribution; 429s are returned at `rate_limit_ratio` and whenever more
+    than `max_inflight` requests are open, 500s at `server_error_ratio`.
+    `prompt_tokens` counts the prompt of every request received, rejected or not.
+    """
+
+    def __init__(self, config: MockConfig):
+        self.config = config
+        self.requests = 0
+        self.rate_limited = 0
+        self.server_errors = 0
+        self.prompt_tokens = 0
+        self._inflight = 0
+        self._lock = threading.Lock()
+        self._rng = random.Random(config.seed)
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/v1"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests = self.rate_limited = self.server_errors = self.prompt_tokens = 0
+
+    def _answer(self, body: dict) -> str:
+        content = body["messages"][-1]["content"]
+        digest = hashlib.sha256(content.encode("utf-8")).digest()
+        if digest[1] / 255 < self.config.invalid_ratio:
+            return "I cannot decide."
+        batch = re.search(r"evaluate (\d+) independent items", content)
+        if batch:
+            return json.dumps([digest[2 + i % 30] % 4 for i in range(int(batch.group(1)))])
+        return str(digest[0] % 4)
+
+    @staticmethod
+    def _prompt_tokens(body: dict) -> int:
+        return sum(main.estimate_tokens(m["content"]) for m in body["messages"])
+
+    def _completion(self, body: dict) -> dict:
+        answer = self._answer(body)
+        prompt_tokens = self._prompt_tokens(body)
+        choice = {"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": answer}}
+        if body.get("logprobs"):
+            top = [{"token": answer[:1], "logprob": -0.1, "bytes": None}] + [
+                {"token": str(i), "logprob": -3.0, "bytes": None} for i in range(4) if str(i) != answer[:1]
+            ]
+            choice["logprobs"] = {"content": [{"token": answer[:1], "logprob": -0.1, "bytes": None, "top_logprobs": top}]}
+        return {
+            "id": "mock",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [choice],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": max(1, len(answer) // 2),
+                "total_tokens": prompt_tokens + max(1, len(answer) // 2),
+            },
+        }
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status: int, payload: dict, headers: dict | None = None):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                config = server.config
+                # Counted for every attempt, so tokens resent by retries show up too
+                prompt_tokens = server._prompt_tokens(body)
+                with server._lock:
+                    server.requests += 1
+                    server.prompt_tokens += prompt_tokens
+                    server._inflight += 1
+                    overloaded = config.max_inflight and server._inflight > config.max_inflight
+                    roll = server._rng.random()
+                    latency = server._rng.lognormvariate(0, config.latency_sigma) * config.latency_median_ms / 1000
+                try:
+                    if overloaded or roll < config.rate_limit_ratio:
+                        with server._lock:
+                            server.rate_limited += 1
+                        self._send(
+                            429,
+                            {"error": {"message": "Rate limit exceeded", "code": 429}},
+                            {"Retry-After": str(config.retry_after)},
+                        )
+                        return
+                    time.sleep(latency)
+                    if roll < config.rate_limit_ratio + config.server_error_ratio:
+                        with server._lock:
+                            server.server_errors += 1
+                        self._send(500, {"error": {"message": "Internal error", "code": 500}})
+                        return
+                    self._send(200, server._completion(body))
+                finally:
+                    with server._lock:
+                        server._inflight -= 1
+
+        return Handler
+
+
+def synthetic_rows(dataset_path: str, size: int) -> list[dict]:
+    """Repeat the rows of `dataset_path` up to `size`, making every prompt unique."""
+    rows = list(run_submission.iter_jsonl(dataset_path))
+    return [
+        {**row, "id": str(i), "prompt": f"{row['prompt']}\n[variant {i}]"}
+        for i, row in enumerate(islice(cycle(rows), size))
+    ]
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def _reset_judge(concurrency: int):
+    main.scheduler = main.AdaptiveScheduler(
+        min(main.INITIAL_CONCURRENCY, concurrency), main.MIN_CONCURRENCY, concurrency, main.TOKENS_PER_MINUTE
+    )
+    for key in main.prompt_stats:
+        main.prompt_stats[key] = 0
+    run_submission.CONCURRENCY = concurrency
+
+
+async def _run_judge(rows: list[dict], concurrency: int) -> tuple[list[int], list[float]]:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def judge(row: dict) -> int:
+        async with semaphore:
+            start = time.perf_counter()
+            index = await main.judge_completions(row["prompt"], row["completions"])
+            latencies.append(time.perf_counter() - start)
+            return index
+
+    return await asyncio.gather(*(judge(row) for row in rows)), latencies
+
+
+async def _run_dataset(rows: list[dict], concurrency: int) -> tuple[list[int], list[float]]:
+    from datasets import Dataset
+
+    latencies = []
+    judge_completions = main.judge_completions
+
+    # async_process_dataset imports judge_completions at call time, so a
+    # timing wrapper installed on the module is picked up
+    async def timed(prompt: str, completions: list[str]) -> int:
+        start = time.perf_counter()
+        index = await judge_completions(prompt, completions)
+        latencies.append(time.perf_counter() - start)
+        return index
+
+    main.judge_completions = timed
+    try:
+        ds = await run_submission.async_process_dataset(Dataset.from_list(rows))
+    finally:
+        main.judge_completions = judge_completions
+    return ds["judged_index"], latencies
+
+
+def run_benchmark(server: MockServer, rows: list[dict], concurrency: int, target: str) -> dict:
+    # A fresh client per run, since its connection pool is bound to the event loop
+    main.client = AsyncOpenAI(base_url=server.base_url, api_key="mock", max_retries=0)
+    _reset_judge(concurrency)
+    server.reset_counters()
+    runner = _run_dataset if target == "dataset" else _run_judge
+
+    start = time.perf_counter()
+    indices, latencies = asyncio.run(runner(rows, concurrency))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "target": target,
+        "concurrency": concurrency,
+        "size": len(rows),
+        "seconds": elapsed,
+        "requests_per_second": server.requests / elapsed,
+        "items_per_second": len(rows) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "invalid_ratio": sum(index == -1 for index in indices) / len(rows),
+        # Tokens the server received, including every retried attempt
+        "tokens_per_item": server.prompt_tokens / len(rows),
+        # First attempts only, as estimated by the judge
+        "estimated_tokens_per_item": main.prompt_stats["input_tokens"] / len(rows),
+        "requests": server.requests,
+        "rate_limited": server.rate_limited,
+        "server_errors": server.server_errors,
+        "retries": main.scheduler.retries,
+    }
+
+
+def print_results(results: list[dict]):
+    header = f"{'target':<8} {'conc':>5} {'size':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'invalid':>8} {'tok/item':>9} {'429':>5} {'5xx':>5}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['target']:<8} {r['concurrency']:>5} {r['size']:>6} {r['requests_per_second']:>8.2f} "
+            f"{r['p50_ms']:>8.0f} {r['p95_ms']:>8.0f} {r['p99_ms']:>8.0f} {r['invalid_ratio']:>8.2%} "
+            f"{r['tokens_per_item']:>9.0f} {r['rate_limited']:>5} {r['server_errors']:>5}"
+        )
+
+
+def compare_to_baseline(results: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    """Return a description of every metric that regressed by more than `tolerance`."""
+    previous = {(r["target"], r["concurrency"], r["size"]): r for r in baseline}
+    regressions = []
+    for r in results:
+        old = previous.get((r["target"], r["concurrency"], r["size"]))
+        if old is None:
+            continue
+        checks = [
+            ("requests_per_second", r["requests_per_second"] < old["requests_per_second"] * (1 - tolerance)),
+            ("p95_ms", r["p95_ms"] > old["p95_ms"] * (1 + tolerance)),
+            ("tokens_per_item", r["tokens_per_item"] > old["tokens_per_item"] * (1 + tolerance)),
+            ("invalid_ratio", r["invalid_ratio"] > old["invalid_ratio"] + tolerance / 10),
+        ]
+        for metric, regressed in checks:
+            if regressed:
+                regressions.append(
+                    f"{r['target']} concurrency={r['concurrency']} size={r['size']}: {metric} {old[metric]:.3f} -> {r[metric]:.3f}"
+                )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset_path", type=str, default="data/dev.jsonl")
+    parser.add_argument("--target", choices=["judge", "dataset"], nargs="+", default=["judge", "dataset"])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[40, 200])
+    parser.add_argument("--latency_median_ms", type=float, default=300.0)
+    parser.add_argument("--latency_sigma", type=float, default=0.5)
+    parser.add_argument("--rate_limit_ratio", type=float, default=0.0)
+    parser.add_argument("--server_error_ratio", type=float, default=0.0)
+    parser.add_argument("--invalid_ratio", type=float, default=0.0)
+    parser.add_argument("--max_inflight", type=int, default=0, help="Return 429 above this many open requests (0 = unlimited)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="Write results as JSON")
+    parser.add_argument("--baseline", type=str, default=None, help="Fail if results regress against this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    config = MockConfig(
+        latency_median_ms=args.latency_median_ms,
+        latency_sigma=args.latency_sigma,
+        rate_limit_ratio=args.rate_limit_ratio,
+        server_error_ratio=args.server_error_ratio,
+        invalid_ratio=args.invalid_ratio,
+        max_inflight=args.max_inflight,
+        seed=args.seed,
+    )
+    results = []
+    with MockServer(config) as server:
+        for target in args.target:
+            for size in args.sizes:
+                rows = synthetic_rows(args.dataset_path, size)
+                for concurrency in args.concurrency:
+                    results.append(run_benchmark(server, rows, concurrency, target))
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
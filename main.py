@@ -1,22 +1,614 @@
 import os
+import re
+import json
+import math
+import time
+import random
+import sqlite3
+import asyncio
+import hashlib
+from collections import deque
 from dotenv import load_dotenv
+import openai
 from openai import AsyncOpenAI
 
 
 load_dotenv()
 
+# Retries are handled by the adaptive scheduler below, so the client must
+# surface 429/5xx responses instead of retrying them internally.
 client = AsyncOpenAI(
   base_url="https://openrouter.ai/api/v1",
-  api_key=os.getenv("OPENROUTER_API_KEY")
+  api_key=os.getenv("OPENROUTER_API_KEY"),
+  max_retries=0
 )
 
-async def judge_completions(prompt: str, completions: list[str]) -> int:
+MODEL = "google/gemini-2.0-flash-001"
+SAMPLING_PARAMS = {"temperature": 0.0, "max_tokens": 10, "top_p": 0.95}
+
+# Verdict cache settings. Set JUDGE_CACHE_PATH to an empty string to disable.
+CACHE_PATH = os.getenv("JUDGE_CACHE_PATH", ".judge_cache.sqlite")
+CACHE_MAX_ENTRIES = int(os.getenv("JUDGE_CACHE_MAX_ENTRIES", "100000"))
+CACHE_MAX_AGE_DAYS = float(os.getenv("JUDGE_CACHE_MAX_AGE_DAYS", "30"))
+# Cache calls run on the event loop, so never wait long for another process's lock
+CACHE_TIMEOUT_SECONDS = float(os.getenv("JUDGE_CACHE_TIMEOUT_SECONDS", "0.1"))
+
+
+class VerdictCache:
     """
-    Judge completions using google/gemini-2.0-flash-001 with few-shot examples.
+    Content-addressed on-disk cache of judged indices, backed by SQLite.
+
+    Entries older than `max_age_days` are dropped when the cache is opened, and
+    the least recently used entries are evicted in chunks once `max_entries`
+    is exceeded. Entries can also hold the probability distribution of a
+    logprob request. SQLite errors (e.g. a database still locked by another
+    worker after `timeout` seconds) are reported and treated as misses,
+    never as failed verdicts.
+    """
+
+    def __init__(self, path: str, max_entries: int, max_age_days: float, timeout: float = CACHE_TIMEOUT_SECONDS):
+        self.path = path
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_days * 24 * 60 * 60
+        self.evict_chunk = max(1, max_entries // 10)
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._conn = None
+        self._count = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            try:
+                # Readers no longer block the writer of another worker
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS verdicts ("
+                    "key TEXT PRIMARY KEY, judged_index INTEGER NOT NULL, "
+                    "created_at REAL NOT NULL, accessed_at REAL NOT NULL, probabilities TEXT)"
+                )
+                columns = [row[1] for row in conn.execute("PRAGMA table_info(verdicts)")]
+                if "probabilities" not in columns:
+                    conn.execute("ALTER TABLE verdicts ADD COLUMN probabilities TEXT")
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS verdicts_accessed_at ON verdicts (accessed_at)"
+                )
+                conn.execute(
+                    "DELETE FROM verdicts WHERE created_at < ?",
+                    (time.time() - self.max_age_seconds,),
+                )
+                conn.commit()
+                self._count = conn.execute("SELECT COUNT(*) FROM verdicts").fetchone()[0]
+            except sqlite3.Error:
+                # Retry the setup on the next call rather than using a half-initialised cache
+                conn.close()
+                raise
+            self._conn = conn
+        return self._conn
+
+    def _error(self, e: sqlite3.Error):
+        self.errors += 1
+        print(f"Cache error in VerdictCache: {e}")
+
+    @staticmethod
+    def make_key(**parts) -> str:
+        payload = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _lookup(self, keys: tuple[str, ...], column: str):
+        try:
+            conn = self._connect()
+            found = dict(conn.execute(
+                f"SELECT key, {column} FROM verdicts "
+                f"WHERE key IN ({', '.join('?' * len(keys))}) AND {column} IS NOT NULL",
+                keys,
+            ).fetchall())
+            key = next((k for k in keys if k in found), None)
+            if key is not None:
+                conn.execute(
+                    "UPDATE verdicts SET accessed_at = ? WHERE key = ?", (time.time(), key)
+                )
+                conn.commit()
+        except sqlite3.Error as e:
+            self._error(e)
+            key = None
+        if key is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return found[key]
+
+    def get(self, *keys: str) -> int | None:
+        """Return the verdict stored under the first of `keys` that has one."""
+        return self._lookup(keys, "judged_index")
+
+    def get_probabilities(self, key: str) -> list[float] | None:
+        value = self._lookup((key,), "probabilities")
+        return json.loads(value) if value is not None else None
+
+    def put(self, key: str, judged_index: int, probabilities: list[float] | None = None):
+        try:
+            conn = self._connect()
+            now = time.time()
+            conn.execute(
+                "INSERT OR REPLACE INTO verdicts (key, judged_index, created_at, accessed_at, probabilities) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, judged_index, now, now, json.dumps(probabilities) if probabilities is not None else None),
+            )
+            self._count += 1
+            if self._count > self.max_entries:
+                self._evict(conn)
+            conn.commit()
+        except sqlite3.Error as e:
+            self._error(e)
+
+    def _evict(self, conn: sqlite3.Connection):
+        # The count is an upper bound (replaced keys and other workers), so
+        # recount before evicting, then drop a whole chunk to amortise the cost
+        self._count = conn.execute("SELECT COUNT(*) FROM verdicts").fetchone()[0]
+        excess = self._count - self.max_entries
+        if excess <= 0:
+            return
+        conn.execute(
+            "DELETE FROM verdicts WHERE key IN ("
+            "SELECT key FROM verdicts ORDER BY accessed_at ASC LIMIT ?)",
+            (excess + self.evict_chunk,),
+        )
+        self._count = max(0, self._count - excess - self.evict_chunk)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "errors": self.errors}
+
+
+verdict_cache = VerdictCache(CACHE_PATH, CACHE_MAX_ENTRIES, CACHE_MAX_AGE_DAYS) if CACHE_PATH else None
+
+# Estimated input tokens above which few-shot examples are dropped.
+INPUT_TOKEN_BUDGET = int(os.getenv("JUDGE_INPUT_TOKEN_BUDGET", "12000"))
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Approximate the token count of `text` without a tokenizer: every word or
+    punctuation mark is one token, and long words add one per 5 characters.
+    """
+    return sum(1 + len(piece) // 5 for piece in re.findall(r"\w+|[^\w\s]", text))
+
+
+def _strip_indent(text: str) -> str:
+    # Prompt literals below are indented by 8 spaces in the source
+    return re.sub(r"\n {8}", "\n", text).strip()
+
+
+# Batched judging settings: items per request and estimated item tokens per request.
+MAX_BATCH_SIZE = int(os.getenv("JUDGE_MAX_BATCH_SIZE", "8"))
+BATCH_TOKEN_BUDGET = int(os.getenv("JUDGE_BATCH_TOKEN_BUDGET", "6000"))
+# Upper bound on batches waiting for the scheduler at once.
+MAX_PENDING_BATCHES = int(os.getenv("JUDGE_MAX_PENDING_BATCHES", "64"))
+
+# Confidence cascade settings: items whose top probability falls below the
+# threshold are re-judged with the completions shuffled.
+CONFIDENCE_THRESHOLD = float(os.getenv("JUDGE_CONFIDENCE_THRESHOLD", "0.7"))
+ESCALATION_PERMUTATIONS = int(os.getenv("JUDGE_ESCALATION_PERMUTATIONS", "3"))
+LOGPROB_PARAMS = {"temperature": 0.0, "max_tokens": 1, "logprobs": True, "top_logprobs": 10}
+
+# Adaptive scheduler settings. A tokens-per-minute budget of 0 disables it.
+INITIAL_CONCURRENCY = int(os.getenv("JUDGE_INITIAL_CONCURRENCY", "4"))
+MIN_CONCURRENCY = int(os.getenv("JUDGE_MIN_CONCURRENCY", "1"))
+MAX_CONCURRENCY = int(os.getenv("JUDGE_MAX_CONCURRENCY", "64"))
+TOKENS_PER_MINUTE = int(os.getenv("JUDGE_TOKENS_PER_MINUTE", "0"))
+MAX_RETRIES = int(os.getenv("JUDGE_MAX_RETRIES", "5"))
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 30.0
+# Latency above this multiple of the best observed latency stops growth.
+LATENCY_TOLERANCE = 2.0
+
+
+class AdaptiveScheduler:
+    """
+    AIMD limiter for in-flight API requests.
+
+    Each healthy response grows the limit by roughly one slot per window of
+    requests, while 429/5xx responses and timeouts halve it (at most once per
+    observed round-trip) and honour any `Retry-After` header. An optional
+    tokens-per-minute budget is enforced over a sliding 60 second window.
+    Blocked callers are parked in FIFO order and woken when a slot frees up
+    or a pause or token wait expires, instead of polling.
+    """
+
+    def __init__(self, initial: int, min_limit: int, max_limit: int, tokens_per_minute: int):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(max(min_limit, min(initial, max_limit)))
+        self.tokens_per_minute = tokens_per_minute
+        self.in_flight = 0
+        self.retries = 0
+        self.throttled = 0
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._latency_ewma = None
+        self._best_latency = None
+        self._token_window = deque()
+        self._tokens_in_window = 0
+        self._waiters = deque()
+        self._timer = None
+        self._timer_loop = None
+
+    def _token_wait(self, now: float, tokens: int) -> float:
+        if self.tokens_per_minute <= 0:
+            return 0.0
+        while self._token_window and now - self._token_window[0][0] >= 60.0:
+            self._tokens_in_window -= self._token_window.popleft()[1]
+        # Always admit a request into an empty window, even if it alone exceeds the budget
+        if not self._token_window or self._tokens_in_window + tokens <= self.tokens_per_minute:
+            return 0.0
+        return 60.0 - (now - self._token_window[0][0])
+
+    def _wake(self):
+        """
+        Admit parked callers in FIFO order while slots and the token budget
+        allow, and set a timer for when a pause or token wait expires.
+        """
+        loop = asyncio.get_running_loop()
+        while self._waiters:
+            future, tokens = self._waiters[0]
+            if future.done():
+                # Cancelled while parked
+                self._waiters.popleft()
+                continue
+            now = time.monotonic()
+            wait = self._paused_until - now
+            if wait <= 0:
+                wait = self._token_wait(now, tokens)
+            if wait > 0:
+                # Only the head waits here, so later callers cannot starve it
+                deadline = loop.time() + wait
+                if self._timer is None or self._timer_loop is not loop or self._timer.when() > deadline:
+                    if self._timer is not None:
+                        self._timer.cancel()
+                    self._timer = loop.call_at(deadline, self._on_timer)
+                    self._timer_loop = loop
+                return
+            if self.in_flight >= int(self.limit):
+                # release() wakes the queue again once a slot frees up
+                return
+            self._waiters.popleft()
+            self._admit(now, tokens)
+            future.set_result(None)
+
+    def _on_timer(self):
+        self._timer = None
+        self._wake()
+
+    def _admit(self, now: float, tokens: int):
+        self.in_flight += 1
+        if self.tokens_per_minute > 0:
+            self._token_window.append((now, tokens))
+            self._tokens_in_window += tokens
+
+    async def acquire(self, tokens: int):
+        now = time.monotonic()
+        if (
+            not self._waiters
+            and self._paused_until <= now
+            and self._token_wait(now, tokens) <= 0
+            and self.in_flight < int(self.limit)
+        ):
+            self._admit(now, tokens)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append((future, tokens))
+        self._wake()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Admitted just before the cancellation, so hand the slot back
+                self.in_flight -= 1
+                self._wake()
+            raise
+
+    def release(
+        self,
+        latency: float | None,
+        throttled: bool = False,
+        retry_after: float | None = None,
+    ):
+        """
+        Free a slot. Pass `latency=None` for calls that failed for reasons
+        unrelated to load (e.g. 400/401), so they neither count as a healthy
+        latency sample nor grow the limit.
+        """
+        self.in_flight -= 1
+        self._update_limit(latency, throttled, retry_after)
+        self._wake()
+
+    def _update_limit(self, latency: float | None, throttled: bool, retry_after: float | None):
+        now = time.monotonic()
+        if throttled:
+            self.throttled += 1
+            if retry_after:
+                self._paused_until = max(self._paused_until, now + retry_after)
+            window = self._latency_ewma or 1.0
+            if now - self._last_decrease >= window:
+                self.limit = max(float(self.min_limit), self.limit / 2)
+                self._last_decrease = now
+            return
+        if latency is None:
+            return
+
+        self._latency_ewma = latency if self._latency_ewma is None else 0.8 * self._latency_ewma + 0.2 * latency
+        self._best_latency = latency if self._best_latency is None else min(self._best_latency, latency)
+        if self._latency_ewma <= LATENCY_TOLERANCE * self._best_latency:
+            self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+
+    def stats(self) -> dict:
+        return {
+            "concurrency": int(self.limit),
+            "retries": self.retries,
+            "throttled": self.throttled,
+        }
+
+
+scheduler = AdaptiveScheduler(INITIAL_CONCURRENCY, MIN_CONCURRENCY, MAX_CONCURRENCY, TOKENS_PER_MINUTE)
+
+# Request budget shared by every process using the same state file, e.g. the
+# workers started by `run_submission.py --workers`. 0 disables it.
+REQUESTS_PER_MINUTE = int(os.getenv("JUDGE_REQUESTS_PER_MINUTE", "0"))
+SHARED_RATE_FILE = os.getenv("JUDGE_SHARED_RATE_FILE", ".judge_rate_limit")
+
+
+class SharedRateLimiter:
+    """
+    Spaces requests at least 60 / `requests_per_minute` seconds apart across
+    processes. Each caller reserves the next free slot in `path` under an
+    exclusive file lock and then sleeps until that slot.
+    """
+
+    def __init__(self, path: str, requests_per_minute: int):
+        self.path = path
+        self.interval = 60.0 / requests_per_minute
+
+    def _reserve(self) -> float:
+        import fcntl
+
+        with open(self.path, "a+", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                content = f.read().strip()
+                now = time.time()
+                slot = max(now, float(content) if content else 0.0)
+                f.seek(0)
+                f.truncate()
+                f.write(repr(slot + self.interval))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return slot - now
+
+    async def wait(self):
+        delay = self._reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+rate_limiter = SharedRateLimiter(SHARED_RATE_FILE, REQUESTS_PER_MINUTE) if REQUESTS_PER_MINUTE > 0 else None
+
+# Telemetry settings. Set JUDGE_TRACE_PATH to write one JSON record per API call.
+TRACE_PATH = os.getenv("JUDGE_TRACE_PATH", "")
+# USD per million tokens, used for the cost estimate in the run summary
+PRICE_PER_M_INPUT_TOKENS = float(os.getenv("JUDGE_PRICE_PER_M_INPUT_TOKENS", "0.10"))
+PRICE_PER_M_OUTPUT_TOKENS = float(os.getenv("JUDGE_PRICE_PER_M_OUTPUT_TOKENS", "0.40"))
+# Latency samples kept for percentiles, independent of the number of calls
+TELEMETRY_SAMPLE_SIZE = 10_000
+
+
+class Telemetry:
+    """
+    Collects one record per judge API call: queue wait, network latency,
+    attempts, token usage, parse outcome and error class.
+
+    Records are appended to `trace_path` (if set) and passed to every
+    registered hook, e.g. a Prometheus exporter. Only aggregates are kept in
+    memory: counters, plus fixed-size reservoir samples of latency and queue
+    wait for the percentiles. Token totals only include usage reported by
+    the provider; calls whose response had none are counted in `usage_missing`.
     """
 
-    # --- SYSTEM PROMPT ---
-    system_prompt = """You are an expert AI judge with extensive experience evaluating AI-generated content.
+    def __init__(self, trace_path: str = ""):
+        self.trace_path = trace_path
+        self.hooks = []
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.usage_missing = 0
+        self.latencies = []
+        self.queue_waits = []
+        self.latency_count = 0
+        self.latency_sum = 0.0
+        self._rng = random.Random(0)
+        self.outcomes = {}
+        self._trace_file = None
+
+    def add_hook(self, hook):
+        """Register a callable invoked with every emitted record."""
+        self.hooks.append(hook)
+
+    def new_record(self, kind: str) -> dict:
+        return {
+            "ts": time.time(),
+            "kind": kind,
+            "queue_wait": 0.0,
+            "latency": None,
+            "attempts": 0,
+            "prompt_tokens": None,
+            "completion_tokens": None,
+            "usage_missing": False,
+            "outcome": None,
+            "error": None,
+            "raw_output": None,
+        }
+
+    def emit(self, record: dict):
+        self.calls += 1
+        self.prompt_tokens += record["prompt_tokens"] or 0
+        self.completion_tokens += record["completion_tokens"] or 0
+        self.usage_missing += record["usage_missing"]
+        if record["latency"] is not None:
+            self.latency_count += 1
+            self.latency_sum += record["latency"]
+            self._sample(self.latencies, self.latency_count, record["latency"])
+        self._sample(self.queue_waits, self.calls, record["queue_wait"])
+        cause = record["outcome"] if record["error"] is None else f"{record['outcome']}:{record['error']}"
+        self.outcomes[cause] = self.outcomes.get(cause, 0) + 1
+
+        if self.trace_path:
+            if self._trace_file is None:
+                self._trace_file = open(self.trace_path, "a", encoding="utf-8")
+            self._trace_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._trace_file.flush()
+        for hook in self.hooks:
+            hook(record)
+
+    def _sample(self, reservoir: list[float], seen: int, value: float):
+        # Reservoir sampling (algorithm R): a uniform sample of all `seen` values
+        if len(reservoir) < TELEMETRY_SAMPLE_SIZE:
+            reservoir.append(value)
+        else:
+            slot = self._rng.randrange(seen)
+            if slot < TELEMETRY_SAMPLE_SIZE:
+                reservoir[slot] = value
+
+    @staticmethod
+    def _percentile(values: list[float], q: float) -> float:
+        if not values:
+            return 0.0
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+    def state(self) -> dict:
+        """JSON-serialisable aggregates, e.g. to combine the telemetry of several workers."""
+        return {
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "usage_missing": self.usage_missing,
+            "latencies": list(self.latencies),
+            "queue_waits": list(self.queue_waits),
+            "outcomes": dict(self.outcomes),
+        }
+
+    @classmethod
+    def summarize(cls, state: dict, elapsed: float) -> dict:
+        cost = (
+            state["prompt_tokens"] * PRICE_PER_M_INPUT_TOKENS + state["completion_tokens"] * PRICE_PER_M_OUTPUT_TOKENS
+        ) / 1_000_000
+        return {
+            "calls": state["calls"],
+            "calls_per_second": state["calls"] / elapsed if elapsed > 0 else 0.0,
+            "latency_p50": cls._percentile(state["latencies"], 50),
+            "latency_p95": cls._percentile(state["latencies"], 95),
+            "latency_p99": cls._percentile(state["latencies"], 99),
+            "queue_wait_p95": cls._percentile(state["queue_waits"], 95),
+            "prompt_tokens": state["prompt_tokens"],
+            "completion_tokens": state["completion_tokens"],
+            "usage_missing": state["usage_missing"],
+            "cost_usd": cost,
+            "outcomes": dict(state["outcomes"]),
+        }
+
+    def summary(self, elapsed: float) -> dict:
+        return self.summarize(self.state(), elapsed)
+
+    def prometheus_text(self) -> str:
+        """Render the aggregates in the Prometheus text exposition format."""
+        lines = [
+            "# TYPE judge_calls_total counter",
+            f"judge_calls_total {self.calls}",
+            "# TYPE judge_tokens_total counter",
+            f'judge_tokens_total{{type="prompt"}} {self.prompt_tokens}',
+            f'judge_tokens_total{{type="completion"}} {self.completion_tokens}',
+            "# TYPE judge_calls_without_usage_total counter",
+            f"judge_calls_without_usage_total {self.usage_missing}",
+            "# TYPE judge_outcomes_total counter",
+        ]
+        lines += [f'judge_outcomes_total{{cause="{cause}"}} {count}' for cause, count in sorted(self.outcomes.items())]
+        lines += ["# TYPE judge_latency_seconds summary"]
+        lines += [
+            f'judge_latency_seconds{{quantile="{q / 100}"}} {self._percentile(self.latencies, q)}'
+            for q in (50, 95, 99)
+        ]
+        lines += [f"judge_latency_seconds_count {self.latency_count}", f"judge_latency_seconds_sum {self.latency_sum}"]
+        return "\n".join(lines) + "\n"
+
+
+telemetry = Telemetry(TRACE_PATH)
+
+
+def _retry_after(error: Exception) -> float | None:
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+async def _create_with_retries(messages: list[dict], input_tokens: int, record: dict, **params):
+    """
+    Send a chat completion through the adaptive scheduler, retrying
+    rate-limited, server-side and transport errors with jittered backoff.
+    `input_tokens` is the estimated prompt size used for the TPM budget.
+    Timings, attempts and token usage are filled into the telemetry `record`.
+    """
+    tokens = input_tokens + params.get("max_tokens", 0)
+    for attempt in range(MAX_RETRIES + 1):
+        queued = time.monotonic()
+        await scheduler.acquire(tokens)
+        if rate_limiter is not None:
+            await rate_limiter.wait()
+        start = time.monotonic()
+        record["queue_wait"] += start - queued
+        record["attempts"] = attempt + 1
+        try:
+            response = await client.chat.completions.create(model=MODEL, messages=messages, **params)
+        except Exception as e:
+            retryable = _is_retryable(e)
+            retry_after = _retry_after(e)
+            record["latency"] = time.monotonic() - start
+            scheduler.release(
+                record["latency"] if retryable else None, throttled=retryable, retry_after=retry_after
+            )
+            if not retryable or attempt == MAX_RETRIES:
+                raise
+            scheduler.retries += 1
+            # Full jitter, but never earlier than the server asked for
+            backoff = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+            await asyncio.sleep(max(backoff, retry_after or 0.0))
+            continue
+        record["latency"] = time.monotonic() - start
+        scheduler.release(record["latency"])
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            record["prompt_tokens"] = usage.prompt_tokens
+            record["completion_tokens"] = usage.completion_tokens
+        else:
+            # Token totals and cost only cover calls whose usage was reported
+            record["usage_missing"] = True
+        return response
+
+
+# --- SYSTEM PROMPT ---
+JUDGE_INSTRUCTIONS = _strip_indent("""You are an expert AI judge with extensive experience evaluating AI-generated content.
 
         Your task is to identify the BEST completion among 4 options by carefully analyzing:
 
@@ -32,15 +624,20 @@ async def judge_completions(prompt: str, completions: list[str]) -> int:
         2. Evaluate each completion against EVERY criterion
         3. Identify any factual errors, logical flaws, or constraint violations
         4. Compare relative strengths and weaknesses
-        5. Select the completion that performs BEST OVERALL
-
-        CRITICAL: Output ONLY a single digit (0, 1, 2, or 3) representing the best completion's index.
-        Do not include any explanation, reasoning, or additional text."""
+        5. Select the completion that performs BEST OVERALL""")
+SYSTEM_PROMPT = JUDGE_INSTRUCTIONS + "\n\n" + _strip_indent("""CRITICAL: Output ONLY a single digit (0, 1, 2, or 3) representing the best completion's index.
+        Do not include any explanation, reasoning, or additional text.""")
 
+# Same criteria for batched requests, but asking for one JSON array of answers
+BATCH_SYSTEM_PROMPT = JUDGE_INSTRUCTIONS + "\n\n" + _strip_indent("""Each example below shows a single item. You will be given several numbered items at once: judge each one on its own in the same way.
+        CRITICAL: Output ONLY a JSON array with one digit per item, in item order, each being the index of that item's best completion (for example [2, 0, 3]).
+        Do not include any explanation, reasoning, or additional text.""")
 
 
-    # --- FEW-SHOT EXAMPLES ---
-    examples = """
+# --- FEW-SHOT EXAMPLES ---
+FEW_SHOT_EXAMPLES = [
+    _strip_indent(example)
+    for example in re.split(r"(?=Example \d+:)", """
         Example 1:
         ORIGINAL PROMPT: Write a 60 word energetic and stylized bio for a pirate character: Khawlah, a brave, fearless, stoic, focused, and immensely talented Muslim female pirate warrior skilled in swordfighting and has encyclopedic tactical knowledge. The response should not repeat any word more than 2 times.
         COMPLETIONS:
@@ -84,64 +681,469 @@ async def judge_completions(prompt: str, completions: list[str]) -> int:
         Explanation:
         [0] acknowledges both leading frameworks with context, which is more informative and balanced. Other options commit to one without acknowledging the nuance, which is less accurate for the question.
         Final answer: 0
-        """
-     # --- USER PROMPT ---
-    user_prompt = f"""{examples}
+        """)
+    if example.strip()
+]
 
-        Now, evaluate the following:
 
-        ORIGINAL PROMPT:
-        {prompt}
+# --- USER PROMPT ---
+ITEM_TEMPLATE = """Now, evaluate the following:
 
-        COMPLETIONS:
-        [0] {completions[0]}
-        [1] {completions[1]}
-        [2] {completions[2]}
-        [3] {completions[3]}
-        Final answer:"""
+ORIGINAL PROMPT:
+{prompt}
 
-    try:
-        response = await client.chat.completions.create(
-            model="google/gemini-2.0-flash-001",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            temperature=0.0,
-            max_tokens=10,
-            top_p=0.95 
+COMPLETIONS:
+{completions}
+Final answer:"""
+
+# Number of completions SYSTEM_PROMPT and the few-shot examples are written for
+PROMPT_NUM_COMPLETIONS = 4
+OPTION_COUNT_NOTE = "(This item has {count} completions, so answer with a single digit from 0 to {last}.)"
+
+# System prompt followed by the first k few-shot examples, for every k. Built
+# once so all requests share a byte-identical prefix that providers can cache.
+PROMPT_PREFIXES = [
+    "\n\n".join([SYSTEM_PROMPT] + FEW_SHOT_EXAMPLES[:k])
+    for k in range(len(FEW_SHOT_EXAMPLES) + 1)
+]
+PREFIX_TOKENS = [estimate_tokens(prefix) for prefix in PROMPT_PREFIXES]
+
+# Batched requests get their own static prefixes, whose examples do not end
+# in the single-digit answer format that would conflict with a JSON array.
+BATCH_FEW_SHOT_EXAMPLES = [
+    example.replace("\nFinal answer: ", "\nBest completion for this item: ") for example in FEW_SHOT_EXAMPLES
+]
+BATCH_PROMPT_PREFIXES = [
+    "\n\n".join([BATCH_SYSTEM_PROMPT] + BATCH_FEW_SHOT_EXAMPLES[:k])
+    for k in range(len(BATCH_FEW_SHOT_EXAMPLES) + 1)
+]
+BATCH_PREFIX_TOKENS = [estimate_tokens(prefix) for prefix in BATCH_PROMPT_PREFIXES]
+
+prompt_stats = {"requests": 0, "input_tokens": 0, "prefix_tokens": 0, "tokens_saved": 0, "trimmed": 0}
+
+
+def render_item(prompt: str, completions: list[str]) -> str:
+    rendered = "\n".join(f"[{i}] {completion}" for i, completion in enumerate(completions))
+    if len(completions) != PROMPT_NUM_COMPLETIONS:
+        # The system prompt assumes 4 options, so say how many this item has,
+        # e.g. after identical completions were collapsed
+        rendered += "\n" + OPTION_COUNT_NOTE.format(count=len(completions), last=len(completions) - 1)
+    return ITEM_TEMPLATE.format(prompt=prompt, completions=rendered)
+
+
+def select_num_examples(item_tokens: int, prefix_tokens: list[int] = PREFIX_TOKENS) -> int:
+    """
+    Return the largest number of few-shot examples that keeps the estimated
+    input within INPUT_TOKEN_BUDGET (possibly 0).
+    """
+    num_examples = len(prefix_tokens) - 1
+    while num_examples > 0 and prefix_tokens[num_examples] + item_tokens > INPUT_TOKEN_BUDGET:
+        num_examples -= 1
+    return num_examples
+
+
+def _messages_for(user_prompt: str, batched: bool = False) -> tuple[list[dict], int, int]:
+    prefixes, prefix_tokens = (BATCH_PROMPT_PREFIXES, BATCH_PREFIX_TOKENS) if batched else (PROMPT_PREFIXES, PREFIX_TOKENS)
+    # Only the user part is tokenised per request; prefix sizes are precomputed
+    user_tokens = estimate_tokens(user_prompt)
+    num_examples = select_num_examples(user_tokens, prefix_tokens)
+    messages = [
+        {"role": "system", "content": prefixes[num_examples]},
+        {"role": "user", "content": user_prompt}
+    ]
+    return messages, num_examples, prefix_tokens[num_examples] + user_tokens
+
+
+def build_messages(prompt: str, completions: list[str]) -> tuple[list[dict], int, int]:
+    """
+    Build the chat messages for one item, dropping few-shot examples from the
+    end until the estimated input fits INPUT_TOKEN_BUDGET.
+
+    Returns the messages, the number of few-shot examples kept and the
+    estimated input tokens.
+    """
+    return _messages_for(render_item(prompt, completions))
+
+
+def record_prompt(input_tokens: int, num_examples: int, batched: bool = False):
+    prefix_tokens = BATCH_PREFIX_TOKENS if batched else PREFIX_TOKENS
+    prompt_stats["requests"] += 1
+    prompt_stats["input_tokens"] += input_tokens
+    prompt_stats["prefix_tokens"] += prefix_tokens[num_examples]
+    prompt_stats["tokens_saved"] += prefix_tokens[-1] - prefix_tokens[num_examples]
+    if num_examples < len(prefix_tokens) - 1:
+        prompt_stats["trimmed"] += 1
+
+
+dedup_stats = {"completions_collapsed": 0, "calls_saved": 0, "tokens_saved": 0}
+
+
+def collapse_completions(completions: list[str]) -> tuple[list[str], list[int]]:
+    """
+    Drop repeated completions, keeping the first occurrence of each.
+
+    Returns the unique completions and, for each of them, its index in the
+    original list.
+    """
+    unique, positions, seen = [], [], set()
+    for i, completion in enumerate(completions):
+        if completion not in seen:
+            seen.add(completion)
+            unique.append(completion)
+            positions.append(i)
+    return unique, positions
+
+
+def _collapse_item(prompt: str, completions: list[str]) -> tuple[list[str], list[int]]:
+    unique, positions = collapse_completions(completions)
+    collapsed = len(completions) - len(unique)
+    if collapsed:
+        dedup_stats["completions_collapsed"] += collapsed
+        dropped = [c for i, c in enumerate(completions) if i not in positions]
+        dedup_stats["tokens_saved"] += sum(estimate_tokens(c) for c in dropped)
+    if len(unique) == 1:
+        # Nothing left to compare, so no request is needed at all
+        dedup_stats["calls_saved"] += 1
+        dedup_stats["tokens_saved"] += estimate_tokens(render_item(prompt, unique)) + PREFIX_TOKENS[-1]
+    return unique, positions
+
+
+async def judge_completions(prompt: str, completions: list[str]) -> int:
+    """
+    Judge completions using google/gemini-2.0-flash-001 with few-shot examples.
+
+    Identical completions are collapsed before prompting and the verdict is
+    mapped back to the first occurrence.
+    """
+    unique, positions = _collapse_item(prompt, completions)
+    if len(unique) == 1:
+        return 0
+    index = await _judge_unique(prompt, unique)
+    return positions[index] if index != -1 else -1
+
+
+async def _judge_unique(prompt: str, completions: list[str]) -> int:
+    messages, num_examples, input_tokens = build_messages(prompt, completions)
+
+    cache_key = None
+    if verdict_cache is not None:
+        cache_key = VerdictCache.make_key(
+            model=MODEL,
+            messages=messages,
+            params=SAMPLING_PARAMS,
         )
+        cached = verdict_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    record_prompt(input_tokens, num_examples)
+    record = telemetry.new_record("judge")
+
+    try:
+        response = await _create_with_retries(messages, input_tokens, record, **SAMPLING_PARAMS)
 
-        
         # Extract the response
-        judgment = response.choices[0].message.content.strip()
-        
+        judgment = (response.choices[0].message.content or "").strip()
+        record["raw_output"] = judgment
+
         # Parse the index - handle various response formats
-        try:
+        if judgment.isdecimal():
             # Try to extract just the number
-            if judgment.isdigit():
-                index = int(judgment)
-            else:
-                # Look for digits in the response
-                import re
-                numbers = re.findall(r'\d', judgment)
-                if numbers:
-                    index = int(numbers[0])
-                else:
-                    # Fallback: return -1 for invalid response
-                    return -1
-            
-            # Validate index is in valid range
-            if 0 <= index <= 3:
-                return index
-            else:
+            index = int(judgment)
+        else:
+            # Look for digits in the response
+            numbers = re.findall(r'\d', judgment)
+            if not numbers:
+                # Fallback: return -1 for invalid response
+                record["outcome"] = "no_digit"
                 return -1
-                
-        except (ValueError, IndexError):
-            # If parsing fails, return -1 to indicate error
+            index = int(numbers[0])
+
+        # Validate index is in valid range
+        if not 0 <= index < len(completions):
+            record["outcome"] = "out_of_range"
             return -1
-            
+        record["outcome"] = "ok"
+        if cache_key is not None:
+            verdict_cache.put(cache_key, index)
+        return index
+
     except Exception as e:
         # Handle API errors gracefully
         print(f"API Error in judge_completions: {e}")
-        return -1
\ No newline at end of file
+        record["outcome"] = "api_error"
+        record["error"] = type(e).__name__
+        return -1
+    finally:
+        telemetry.emit(record)
+
+
+BATCH_TEMPLATE = """You will evaluate {count} independent items. Judge each item on its own, exactly as you would if it were the only one.
+
+{items}
+
+Output ONLY a JSON array of {count} digits, one per item in order (for example [2, 0, 3]). Do not include any explanation.
+Final answers:"""
+
+
+def plan_batches(items: list[dict]) -> list[list[int]]:
+    """
+    Group item positions into batches whose estimated item tokens fit
+    BATCH_TOKEN_BUDGET, with at most MAX_BATCH_SIZE items each. Items that
+    exceed the budget on their own end up in a batch of one.
+    """
+    batches = []
+    current, current_tokens = [], 0
+    for i, item in enumerate(items):
+        tokens = estimate_tokens(render_item(item["prompt"], item["completions"]))
+        if current and (current_tokens + tokens > BATCH_TOKEN_BUDGET or len(current) >= MAX_BATCH_SIZE):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def parse_batch_judgment(judgment: str, num_completions: list[int]) -> list[int]:
+    """
+    Parse a JSON array of indices from the model output, one per item, where
+    `num_completions` holds each item's number of completions. Entries that
+    are missing, invalid or out of range for their item are returned as -1.
+    """
+    count = len(num_completions)
+    match = re.search(r"\[[^\[\]]*\]", judgment)
+    if match is None:
+        return [-1] * count
+    try:
+        values = json.loads(match.group(0))
+    except ValueError:
+        return [-1] * count
+    if not isinstance(values, list) or len(values) != count:
+        return [-1] * count
+    indices = []
+    for value, n in zip(values, num_completions):
+        text = str(value).strip() if isinstance(value, (int, str)) and not isinstance(value, bool) else ""
+        indices.append(int(text) if text.isdecimal() and int(text) < n else -1)
+    return indices
+
+
+def _batch_cache_keys(item: dict) -> tuple[str, str]:
+    """
+    Return the key of the item's batched verdict, which is kept apart from
+    per-item verdicts, and the key `judge_completions` stores it under.
+    """
+    messages, _, _ = build_messages(item["prompt"], item["completions"])
+    return (
+        VerdictCache.make_key(model=MODEL, messages=messages, params=SAMPLING_PARAMS, batched=True),
+        VerdictCache.make_key(model=MODEL, messages=messages, params=SAMPLING_PARAMS),
+    )
+
+
+async def _request_batch(items: list[dict]) -> list[int]:
+    rendered = [
+        f"ITEM {i + 1}:\n{render_item(item['prompt'], item['completions'])}"
+        for i, item in enumerate(items)
+    ]
+    user_prompt = BATCH_TEMPLATE.format(count=len(items), items="\n\n".join(rendered))
+    messages, num_examples, input_tokens = _messages_for(user_prompt, batched=True)
+    params = {**SAMPLING_PARAMS, "max_tokens": 4 * len(items) + 10}
+
+    record_prompt(input_tokens, num_examples, batched=True)
+    record = telemetry.new_record("batch")
+    try:
+        response = await _create_with_retries(messages, input_tokens, record, **params)
+        record["raw_output"] = response.choices[0].message.content
+        indices = parse_batch_judgment(
+            record["raw_output"] or "", [len(item["completions"]) for item in items]
+        )
+        invalid = indices.count(-1)
+        record["outcome"] = "ok" if invalid == 0 else "invalid_batch" if invalid == len(items) else "partial_batch"
+        return indices
+    except Exception as e:
+        print(f"API Error in judge_completions_batch: {e}")
+        record["outcome"] = "api_error"
+        record["error"] = type(e).__name__
+        return [-1] * len(items)
+    finally:
+        telemetry.emit(record)
+
+
+async def _judge_batch(items: list[dict]) -> list[int]:
+    # A batch of one is just a regular request
+    indices = await _request_batch(items) if len(items) > 1 else [-1]
+
+    # Re-judge anything the batch could not answer on its own
+    fallbacks = [i for i, index in enumerate(indices) if index == -1]
+    fallback_indices = await asyncio.gather(
+        *(judge_completions(items[i]["prompt"], items[i]["completions"]) for i in fallbacks)
+    )
+    for i, index in zip(fallbacks, fallback_indices):
+        indices[i] = index
+
+    if verdict_cache is not None:
+        for item, index in zip(items, indices):
+            if index != -1:
+                verdict_cache.put(_batch_cache_keys(item)[0], index)
+    return indices
+
+
+async def judge_completions_batch(items: list[dict]) -> list[int]:
+    """
+    Judge several items, each a dict with "prompt" and "completions", packing
+    as many as fit into a single request. Entries the batched answer does not
+    cover are judged individually with `judge_completions`.
+    """
+    results = [-1] * len(items)
+    pending, pending_items, pending_positions = [], [], []
+    for i, item in enumerate(items):
+        unique, positions = _collapse_item(item["prompt"], item["completions"])
+        if len(unique) == 1:
+            results[i] = 0
+            continue
+        item = {"prompt": item["prompt"], "completions": unique}
+        # Prefer an earlier batched verdict, but reuse one from `judge_completions` too
+        cached = verdict_cache.get(*_batch_cache_keys(item)) if verdict_cache is not None else None
+        if cached is None:
+            pending.append(i)
+            pending_items.append(item)
+            pending_positions.append(positions)
+        else:
+            results[i] = positions[cached]
+
+    semaphore = asyncio.Semaphore(MAX_PENDING_BATCHES)
+    async def process_batch(batch: list[int]) -> list[int]:
+        async with semaphore:
+            return await _judge_batch([pending_items[j] for j in batch])
+
+    batches = plan_batches(pending_items)
+    batch_results = await asyncio.gather(*(process_batch(batch) for batch in batches))
+    for batch, indices in zip(batches, batch_results):
+        for j, index in zip(batch, indices):
+            results[pending[j]] = pending_positions[j][index] if index != -1 else -1
+    return results
+
+
+cascade_stats = {"items": 0, "escalated": 0, "extra_calls": 0, "no_logprobs": 0}
+
+
+def parse_probabilities(response, num_completions: int) -> tuple[list[float] | None, bool]:
+    """
+    Turn the top logprobs of the first output token into a normalised
+    distribution over completion indices. Falls back to a one-hot
+    distribution on the parsed digit when no logprobs are returned.
+
+    Returns the distribution (None if nothing could be parsed) and whether it
+    came from logprobs.
+    """
+    choice = response.choices[0]
+    content = getattr(choice, "logprobs", None) and choice.logprobs.content
+    if content:
+        probabilities = [0.0] * num_completions
+        # Some providers return logprobs without alternatives; use the one-hot fallback then
+        for candidate in content[0].top_logprobs or []:
+            token = candidate.token.strip()
+            if token.isdigit() and int(token) < num_completions:
+                probabilities[int(token)] += math.exp(candidate.logprob)
+        total = sum(probabilities)
+        if total > 0:
+            return [p / total for p in probabilities], True
+
+    numbers = re.findall(r"\d", choice.message.content or "")
+    if numbers and int(numbers[0]) < num_completions:
+        return [1.0 if i == int(numbers[0]) else 0.0 for i in range(num_completions)], False
+    return None, False
+
+
+async def judge_probabilities(prompt: str, completions: list[str]) -> list[float] | None:
+    """
+    Request a single answer token with logprobs and return the probability of
+    each completion being the best, or None if no verdict could be parsed.
+    """
+    messages, num_examples, input_tokens = build_messages(prompt, completions)
+
+    cache_key = None
+    if verdict_cache is not None:
+        cache_key = VerdictCache.make_key(model=MODEL, messages=messages, params=LOGPROB_PARAMS)
+        cached = verdict_cache.get_probabilities(cache_key)
+        if cached is not None:
+            return cached
+
+    record_prompt(input_tokens, num_examples)
+    record = telemetry.new_record("probabilities")
+    try:
+        response = await _create_with_retries(messages, input_tokens, record, **LOGPROB_PARAMS)
+        record["raw_output"] = response.choices[0].message.content
+        probabilities, from_logprobs = parse_probabilities(response, len(completions))
+        if probabilities is None:
+            record["outcome"] = "no_digit"
+        elif not from_logprobs:
+            # A one-hot fallback always looks fully confident and is never escalated
+            cascade_stats["no_logprobs"] += 1
+            record["outcome"] = "no_logprobs"
+        else:
+            record["outcome"] = "ok"
+            if cache_key is not None:
+                index = max(range(len(probabilities)), key=lambda i: probabilities[i])
+                verdict_cache.put(cache_key, index, probabilities)
+        return probabilities
+    except Exception as e:
+        print(f"API Error in judge_probabilities: {e}")
+        record["outcome"] = "api_error"
+        record["error"] = type(e).__name__
+        return None
+    finally:
+        telemetry.emit(record)
+
+
+async def _judge_shifted(prompt: str, completions: list[str], shift: int) -> list[float] | None:
+    n = len(completions)
+    shifted = [completions[(i + shift) % n] for i in range(n)]
+    probabilities = await judge_probabilities(prompt, shifted)
+    if probabilities is None:
+        return None
+    # Position i of the shifted list holds original completion (i + shift) % n
+    return [probabilities[(i - shift) % n] for i in range(n)]
+
+
+async def judge_completions_cascade(prompt: str, completions: list[str]) -> dict:
+    """
+    Judge with a single logprob request and only escalate low-confidence items
+    to re-judging with cyclically shifted completions, averaging the
+    distributions.
+
+    Returns a dict with "judged_index", "confidence", "probabilities" and the
+    "tier" that produced the verdict (0 = no request needed because all
+    completions are identical, 1 = single request, 2 = escalated).
+    """
+    cascade_stats["items"] += 1
+    original_count = len(completions)
+    completions, positions = _collapse_item(prompt, completions)
+    n = len(completions)
+    if n == 1:
+        probabilities = [1.0] + [0.0] * (original_count - 1)
+        return {"judged_index": 0, "confidence": 1.0, "probabilities": probabilities, "tier": 0}
+
+    probabilities = await judge_probabilities(prompt, completions)
+    tier = 1
+
+    if probabilities is None or max(probabilities) < CONFIDENCE_THRESHOLD:
+        tier = 2
+        # Distinct shifts only: repeating one at temperature 0 returns the same answer
+        shifts = list(range(1, n))[:ESCALATION_PERMUTATIONS]
+        cascade_stats["escalated"] += 1
+        cascade_stats["extra_calls"] += len(shifts)
+        results = await asyncio.gather(*(_judge_shifted(prompt, completions, shift) for shift in shifts))
+        distributions = [d for d in [probabilities, *results] if d is not None]
+        if distributions:
+            probabilities = [sum(d[i] for d in distributions) / len(distributions) for i in range(n)]
+
+    if probabilities is None:
+        return {"judged_index": -1, "confidence": 0.0, "probabilities": None, "tier": tier}
+    index = max(range(n), key=lambda i: probabilities[i])
+    # Report the distribution over the original completions; duplicates get 0
+    expanded = [0.0] * original_count
+    for unique_index, position in enumerate(positions):
+        expanded[position] = probabilities[unique_index]
+    return {"judged_index": positions[index], "confidence": probabilities[index], "probabilities": expanded, "tier": tier}
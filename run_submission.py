@@ -1,5 +1,16 @@
 from dotenv import load_dotenv
 from time import perf_counter
+from itertools import islice
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
 import pandas as pd
 import argparse
 from datasets import Dataset, load_dataset
@@ -9,7 +20,17 @@ from tqdm.asyncio import tqdm
 
 load_dotenv()
 
-CONCURRENCY = 1
+# Upper bound on pending judge calls. The number of requests actually in
+# flight is adapted at runtime by the scheduler in main.py.
+CONCURRENCY = 64
+
+# Rows whose prompt and every completion reach this shingle Jaccard similarity
+# with an earlier row reuse its verdict. 1.0 restricts dedup to exact copies.
+NEAR_DUPLICATE_THRESHOLD = 0.9
+MINHASH_PERMUTATIONS = 32
+MINHASH_BANDS = 8
+
+dedup_report = {"duplicates": 0, "calls_saved": 0, "tokens_saved": 0}
 
 
 async def async_process_dataset(ds: Dataset) -> Dataset:
@@ -26,6 +47,482 @@ async def async_process_dataset(ds: Dataset) -> Dataset:
     
     return ds.add_column("judged_index", judged_indices)
 
+async def async_process_dataset_batched(ds: Dataset) -> Dataset:
+    """Like `async_process_dataset`, but packs several rows into each API request."""
+    from main import judge_completions_batch
+
+    judged_indices = await judge_completions_batch(
+        [{"prompt": example["prompt"], "completions": example["completions"]} for example in ds]
+    )
+    return ds.add_column("judged_index", judged_indices)
+
+async def async_process_dataset_cascade(ds: Dataset) -> Dataset:
+    """Like `async_process_dataset`, but escalates low-confidence verdicts."""
+    from main import judge_completions_cascade
+
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    async def process_example(example: dict) -> dict:
+        async with semaphore:
+            return await judge_completions_cascade(example["prompt"], example["completions"])
+
+    results = await tqdm.gather(*[process_example(example) for example in ds])
+
+    ds = ds.add_column("judged_index", [r["judged_index"] for r in results])
+    ds = ds.add_column("judge_confidence", [r["confidence"] for r in results])
+    return ds.add_column("judge_tier", [r["tier"] for r in results])
+
+def iter_jsonl(path: str):
+    """Lazily yield rows from a JSONL file, using the line number as id if a row has none."""
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f):
+            if line.strip():
+                row = json.loads(line)
+                row.setdefault("id", str(line_number))
+                yield row
+
+def load_completed_ids(output_path: str) -> set:
+    """
+    Return the ids already judged in `output_path`. Rows with invalid verdicts
+    or truncated by a crash are dropped from the file so they are redone.
+    """
+    if not os.path.exists(output_path):
+        return set()
+
+    kept = []
+    # Also rewrite when a valid last line lost its newline, or the next
+    # appended row would be glued onto it
+    rewrite = False
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                rewrite = True
+                continue
+            if row.get("judged_index", -1) == -1:
+                rewrite = True
+                continue
+            if not line.endswith("\n"):
+                rewrite = True
+                line += "\n"
+            kept.append((str(row["id"]), line))
+
+    if rewrite:
+        tmp_path = output_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(line for _, line in kept)
+        os.replace(tmp_path, output_path)
+    return {row_id for row_id, _ in kept}
+
+_MINHASH_PRIME = (1 << 31) - 1
+_minhash_rng = np.random.default_rng(0)
+_MINHASH_A = _minhash_rng.integers(1, _MINHASH_PRIME, size=MINHASH_PERMUTATIONS, dtype=np.int64)
+_MINHASH_B = _minhash_rng.integers(0, _MINHASH_PRIME, size=MINHASH_PERMUTATIONS, dtype=np.int64)
+
+def _shingles(text: str, size: int = 3) -> set:
+    words = text.lower().split()
+    if len(words) <= size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+def _jaccard(a: set, b: set) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+def minhash_signature(shingles: set) -> np.ndarray:
+    hashes = np.array([zlib.crc32(s.encode("utf-8")) % _MINHASH_PRIME for s in shingles], dtype=np.int64)
+    return ((np.outer(_MINHASH_A, hashes) + _MINHASH_B[:, None]) % _MINHASH_PRIME).min(axis=1)
+
+def row_key(row: dict) -> str:
+    payload = json.dumps([row["prompt"], row["completions"]], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def _record_duplicate(row: dict):
+    from main import build_messages
+
+    _, _, input_tokens = build_messages(row["prompt"], row["completions"])
+    dedup_report["duplicates"] += 1
+    dedup_report["calls_saved"] += 1
+    dedup_report["tokens_saved"] += input_tokens
+
+def find_duplicates(rows: list[dict], threshold: float = NEAR_DUPLICATE_THRESHOLD) -> list[int]:
+    """
+    Map every row to the position of the row whose verdict it can reuse:
+    itself if it is unique, otherwise the first exact copy or near-duplicate.
+
+    Near-duplicate candidates come from MinHash LSH over the prompt shingles
+    and are confirmed by checking the prompt and each completion position.
+    """
+    rows_per_band = MINHASH_PERMUTATIONS // MINHASH_BANDS
+    representatives = []
+    exact = {}
+    buckets = {}
+    fields_by_row = {}
+    for i, row in enumerate(rows):
+        key = row_key(row)
+        if key in exact:
+            representatives.append(exact[key])
+            _record_duplicate(row)
+            continue
+        exact[key] = i
+        if threshold >= 1.0:
+            representatives.append(i)
+            continue
+
+        fields = [_shingles(row["prompt"])] + [_shingles(c) for c in row["completions"]]
+        signature = minhash_signature(fields[0])
+        bands = [(b, signature[b * rows_per_band:(b + 1) * rows_per_band].tobytes()) for b in range(MINHASH_BANDS)]
+        candidates = sorted({candidate for band in bands for candidate in buckets.get(band, [])})
+        match = next(
+            (
+                candidate for candidate in candidates
+                if len(fields_by_row[candidate]) == len(fields)
+                and all(_jaccard(a, b) >= threshold for a, b in zip(fields, fields_by_row[candidate]))
+            ),
+            None,
+        )
+        if match is not None:
+            representatives.append(match)
+            _record_duplicate(row)
+            continue
+
+        fields_by_row[i] = fields
+        for band in bands:
+            buckets.setdefault(band, []).append(i)
+        representatives.append(i)
+    return representatives
+
+async def async_process_deduplicated(ds: Dataset, process) -> Dataset:
+    """
+    Run `process` on the unique rows of `ds` only and fan the added columns
+    back out to every duplicate row.
+    """
+    representatives = find_duplicates(
+        [{"prompt": p, "completions": c} for p, c in zip(ds["prompt"], ds["completions"])]
+    )
+    unique_indices = sorted(set(representatives))
+    judged_ds = await process(ds.select(unique_indices))
+
+    position = {index: j for j, index in enumerate(unique_indices)}
+    for column in judged_ds.column_names:
+        if column not in ds.column_names:
+            values = judged_ds[column]
+            ds = ds.add_column(column, [values[position[r]] for r in representatives])
+    return ds
+
+async def async_process_stream(
+    dataset_path: str,
+    output_path: str,
+    resume: bool = False,
+    limit: int | None = None,
+    dedup: bool = False,
+    cascade: bool = False,
+) -> int:
+    """
+    Judge `dataset_path` row by row with at most CONCURRENCY rows in flight,
+    appending each verdict to `output_path` as soon as it completes.
+    With `resume`, rows whose id is already in the output are skipped.
+    With `dedup`, exact duplicate rows share a single judge call; near
+    duplicates are not detected since rows are never all in memory. Dedup
+    keeps a row hash and the verdict columns of every unique row, so its
+    memory grows by roughly 350 bytes per unique row.
+    With `cascade`, rows are judged by the confidence cascade and also get
+    the judge_confidence and judge_tier columns.
+    Returns the number of rows judged in this run.
+    """
+    from main import judge_completions, judge_completions_cascade
+
+    completed_ids = load_completed_ids(output_path) if resume else set()
+    rows = (row for row in islice(iter_jsonl(dataset_path), limit) if str(row["id"]) not in completed_ids)
+    verdicts = {}
+
+    async def judge(example: dict) -> dict:
+        if not cascade:
+            return {"judged_index": await judge_completions(example["prompt"], example["completions"])}
+        result = await judge_completions_cascade(example["prompt"], example["completions"])
+        return {
+            "judged_index": result["judged_index"],
+            "judge_confidence": result["confidence"],
+            "judge_tier": result["tier"],
+        }
+
+    async def process_example(example: dict) -> dict:
+        if not dedup:
+            example.update(await judge(example))
+            return example
+        key = row_key(example)
+        if key in verdicts:
+            _record_duplicate(example)
+            verdict = verdicts[key]
+            if asyncio.isfuture(verdict):
+                verdict = await verdict
+        else:
+            future = verdicts[key] = asyncio.ensure_future(judge(example))
+            verdict = await future
+            # Keep just the verdict columns once judged, not the finished task
+            verdicts[key] = verdict
+        example.update(verdict)
+        return example
+
+    judged = 0
+    pending = set()
+    with open(output_path, "a" if resume else "w", encoding="utf-8") as out, tqdm(initial=len(completed_ids)) as progress:
+        async def write_finished(return_when: str):
+            nonlocal judged, pending
+            finished, pending = await asyncio.wait(pending, return_when=return_when)
+            for task in finished:
+                out.write(json.dumps(task.result(), ensure_ascii=False) + "\n")
+                judged += 1
+            out.flush()
+            progress.update(len(finished))
+
+        for row in rows:
+            if len(pending) >= CONCURRENCY:
+                await write_finished(asyncio.FIRST_COMPLETED)
+            pending.add(asyncio.create_task(process_example(row)))
+        if pending:
+            await write_finished(asyncio.ALL_COMPLETED)
+    return judged
+
+def start_metrics_server(port: int):
+    """Serve the judge telemetry in Prometheus text format on http://127.0.0.1:<port>/metrics."""
+    from main import telemetry
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            data = telemetry.prometheus_text().encode("utf-8")
+            self.send_response(200 if self.path == "/metrics" else 404)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def print_telemetry_summary(telemetry_state: dict, elapsed: float):
+    from main import Telemetry
+
+    summary = Telemetry.summarize(telemetry_state, elapsed)
+    print(f"API calls: {summary['calls']} ({summary['calls_per_second']:.2f}/s)")
+    print(
+        f"Latency p50/p95/p99: {summary['latency_p50']:.2f}s / {summary['latency_p95']:.2f}s / "
+        f"{summary['latency_p99']:.2f}s, queue wait p95: {summary['queue_wait_p95']:.2f}s"
+    )
+    print(
+        f"Tokens: {summary['prompt_tokens']} prompt, {summary['completion_tokens']} completion, "
+        f"estimated cost: ${summary['cost_usd']:.4f}"
+    )
+    if summary["usage_missing"]:
+        print(f"WARNING: {summary['usage_missing']} calls reported no token usage and are missing from the totals")
+    outcomes = ", ".join(f"{cause}: {count}" for cause, count in sorted(summary["outcomes"].items()))
+    print(f"Calls by outcome: {outcomes or 'none'}")
+
+def collect_run_stats(elapsed: float) -> dict:
+    """Gather the counters of this process, so shard workers can report them to the launcher."""
+    from main import cascade_stats, dedup_stats, prompt_stats, scheduler, telemetry, verdict_cache
+
+    return {
+        "elapsed": elapsed,
+        "telemetry": telemetry.state(),
+        "cascade": dict(cascade_stats),
+        "dedup_rows": dict(dedup_report),
+        "dedup_completions": dict(dedup_stats),
+        "prompt": dict(prompt_stats),
+        "scheduler": scheduler.stats(),
+        "cache": verdict_cache.stats() if verdict_cache is not None else None,
+    }
+
+def merge_run_stats(stats: list[dict]) -> dict:
+    """
+    Combine the stats of several workers: counters are summed, latency
+    samples concatenated and elapsed time is the slowest worker's.
+    """
+    def combine(values: list):
+        present = [v for v in values if v is not None]
+        if not present:
+            return None
+        if isinstance(present[0], dict):
+            keys = dict.fromkeys(k for v in present for k in v)
+            return {k: combine([v.get(k) for v in present]) for k in keys}
+        if isinstance(present[0], list):
+            return [item for v in present for item in v]
+        return sum(present)
+
+    merged = combine(stats)
+    merged["elapsed"] = max(s["elapsed"] for s in stats)
+    return merged
+
+def print_run_summary(stats: dict, output_path: str, cascade: bool = False, dedup: bool = False):
+    accuracy, ratio_valid = calculate_accuracy(output_path)
+    print(f"Accuracy: {accuracy}")
+    print(f"Ratio valid judgements: {ratio_valid}")
+    print_telemetry_summary(stats["telemetry"], stats["elapsed"])
+
+    if cascade:
+        from main import CONFIDENCE_THRESHOLD
+
+        cascade_stats = stats["cascade"]
+        escalation_rate = cascade_stats["escalated"] / max(cascade_stats["items"], 1)
+        print(f"Confidence threshold: {CONFIDENCE_THRESHOLD}, escalation rate: {escalation_rate:.2%}, extra calls: {cascade_stats['extra_calls']}")
+        if cascade_stats["no_logprobs"]:
+            print(
+                f"WARNING: {cascade_stats['no_logprobs']} calls returned no logprobs and were scored "
+                f"as fully confident, so they could not be escalated"
+            )
+        for tier, tier_accuracy in calculate_tier_accuracy(output_path).items():
+            print(f"Tier {tier} accuracy: {tier_accuracy}")
+
+    if dedup:
+        rows = stats["dedup_rows"]
+        print(
+            f"Duplicate rows: {rows['duplicates']}, calls saved: {rows['calls_saved']}, "
+            f"estimated tokens saved: {rows['tokens_saved']}"
+        )
+    completions = stats["dedup_completions"]
+    print(
+        f"Collapsed completions: {completions['completions_collapsed']}, calls saved: {completions['calls_saved']}, "
+        f"estimated tokens saved: {completions['tokens_saved']}"
+    )
+    prompt = stats["prompt"]
+    print(
+        f"Estimated input tokens: {prompt['input_tokens']} "
+        f"({prompt['prefix_tokens']} in cacheable prefix), "
+        f"saved by few-shot trimming: {prompt['tokens_saved']} "
+        f"({prompt['trimmed']}/{prompt['requests']} requests trimmed)"
+    )
+    scheduler = stats["scheduler"]
+    print(f"Final concurrency: {scheduler['concurrency']}, retries: {scheduler['retries']}, throttled: {scheduler['throttled']}")
+    if stats["cache"] is not None:
+        cache = stats["cache"]
+        print(f"Cache hits: {cache['hits']}, misses: {cache['misses']}, errors: {cache['errors']}")
+
+def shard_output_path(output_path: str, shard_index: int, num_shards: int) -> str:
+    return f"{output_path}.shard-{shard_index:05d}-of-{num_shards:05d}"
+
+def shard_rows(num_rows: int, shard_index: int, num_shards: int) -> range:
+    """
+    Contiguous slice of rows for a shard, split like `Dataset.shard(contiguous=True)`
+    but allowing empty shards when there are more shards than rows.
+    """
+    div, mod = divmod(num_rows, num_shards)
+    start = div * shard_index + min(shard_index, mod)
+    return range(start, start + div + (shard_index < mod))
+
+def shard_stats_path(output_path: str, shard_index: int, num_shards: int) -> str:
+    return shard_output_path(output_path, shard_index, num_shards) + ".stats.json"
+
+def load_full_dataset(dataset_path: str, debug: bool = False) -> Dataset:
+    ds = load_dataset("json", data_files=dataset_path, split="train")
+    if debug:
+        ds = ds.select(range(2))
+    return ds
+
+def merge_shards(dataset_path: str, output_path: str, num_shards: int, debug: bool = False):
+    """
+    Reassemble the shard outputs of `output_path` in dataset order and write
+    them exactly as a single-process run would.
+    """
+    ds = load_full_dataset(dataset_path, debug)
+    added = {}
+    rows = 0
+    # Shards are contiguous, so concatenating them in order restores the dataset order
+    for shard_index in range(num_shards):
+        with open(shard_output_path(output_path, shard_index, num_shards), encoding="utf-8") as f:
+            for line in f:
+                row = json.loads(line)
+                rows += 1
+                for column, value in row.items():
+                    if column not in ds.column_names:
+                        added.setdefault(column, []).append(value)
+    if rows != len(ds):
+        raise ValueError(f"Shard outputs contain {rows} rows, expected {len(ds)}")
+    for column, values in added.items():
+        ds = ds.add_column(column, values)
+    ds.to_json(output_path, orient="records", lines=True)
+
+def merge_and_report(
+    dataset_path: str,
+    output_path: str,
+    num_shards: int,
+    debug: bool = False,
+    cascade: bool = False,
+    dedup: bool = False,
+    elapsed: float | None = None,
+):
+    """Merge the shard outputs, then compute accuracy and the combined summary once."""
+    merge_shards(dataset_path, output_path, num_shards, debug=debug)
+    stats = []
+    for shard_index in range(num_shards):
+        with open(shard_stats_path(output_path, shard_index, num_shards), encoding="utf-8") as f:
+            stats.append(json.load(f))
+    merged = merge_run_stats(stats)
+    if elapsed is not None:
+        merged["elapsed"] = elapsed
+    print_run_summary(merged, output_path, cascade=cascade, dedup=dedup)
+
+def run_workers(args: argparse.Namespace):
+    """
+    Judge the dataset with `args.workers` processes, one contiguous shard
+    each, then merge their outputs. A JUDGE_REQUESTS_PER_MINUTE budget is
+    shared by all workers through a fresh lock file, and a
+    JUDGE_TOKENS_PER_MINUTE budget is split evenly between them.
+    """
+    env = dict(os.environ)
+    tokens_per_minute = int(env.get("JUDGE_TOKENS_PER_MINUTE", "0"))
+    if tokens_per_minute > 0:
+        # Each worker enforces its token budget locally, so give each its share
+        env["JUDGE_TOKENS_PER_MINUTE"] = str(max(1, tokens_per_minute // args.workers))
+    rate_file = None
+    if int(env.get("JUDGE_REQUESTS_PER_MINUTE", "0")) > 0:
+        fd, rate_file = tempfile.mkstemp(prefix="judge_rate_")
+        os.close(fd)
+        env["JUDGE_SHARED_RATE_FILE"] = rate_file
+
+    flags = [f"--{name}" for name in ("debug", "batch", "cascade", "dedup") if getattr(args, name)]
+    if args.trace_path:
+        flags += ["--trace_path", args.trace_path]
+    start_time = perf_counter()
+    processes = []
+    for shard_index in range(args.workers):
+        worker_flags = list(flags)
+        if args.metrics_port:
+            worker_flags += ["--metrics_port", str(args.metrics_port + shard_index)]
+        processes.append(subprocess.Popen(
+            [
+                sys.executable, os.path.abspath(__file__),
+                "--dataset_path", args.dataset_path,
+                "--output_path", args.output_path,
+                "--num_shards", str(args.workers),
+                "--shard_index", str(shard_index),
+                *worker_flags,
+            ],
+            env=env,
+        ))
+    failed = [i for i, process in enumerate(processes) if process.wait() != 0]
+    if rate_file is not None:
+        os.remove(rate_file)
+    if failed:
+        raise SystemExit(f"Shards {failed} failed")
+
+    merge_and_report(
+        args.dataset_path,
+        args.output_path,
+        args.workers,
+        debug=args.debug,
+        cascade=args.cascade,
+        dedup=args.dedup,
+        elapsed=perf_counter() - start_time,
+    )
+
+def calculate_tier_accuracy(output_path: str) -> dict:
+    df = pd.read_json(output_path, lines=True)
+    df["is_correct"] = df["judged_index"] == df["chosen_index"]
+    return df.groupby("judge_tier")["is_correct"].mean().to_dict()
+
 def calculate_accuracy(output_path: str):
     print(f"Calculating accuracy from {output_path}")
     df = pd.read_json(output_path, lines=True)
@@ -38,31 +535,122 @@ def calculate_accuracy(output_path: str):
     ratio_valid = df["judged_index"] != -1
     return df["is_correct"].mean(), ratio_valid.mean()
 
-def main(dataset_path: str, output_path: str, debug: bool = False):
-    print(f"Running on {dataset_path} and saving to {output_path}")
-    ds = load_dataset("json", data_files=dataset_path, split="train")
-    if debug:
-        ds = ds.select(range(2))
+def main(
+    dataset_path: str,
+    output_path: str,
+    debug: bool = False,
+    batch: bool = False,
+    cascade: bool = False,
+    stream: bool = False,
+    resume: bool = False,
+    trace_path: str | None = None,
+    metrics_port: int | None = None,
+    dedup: bool = False,
+    num_shards: int = 1,
+    shard_index: int = 0,
+):
+    shard_path = shard_output_path(output_path, shard_index, num_shards) if num_shards > 1 else output_path
+    print(f"Running on {dataset_path} and saving to {shard_path}")
+    if trace_path:
+        from main import telemetry
+        telemetry.trace_path = trace_path
+    if metrics_port:
+        start_metrics_server(metrics_port)
 
     start_time = perf_counter()
-    submission_ds = asyncio.run(async_process_dataset(ds))
+    submission_ds = None
+    if stream or resume:
+        judged = asyncio.run(
+            async_process_stream(
+                dataset_path, shard_path, resume=resume, limit=2 if debug else None, dedup=dedup, cascade=cascade
+            )
+        )
+        print(f"Judged {judged} rows in this run")
+    else:
+        ds = load_full_dataset(dataset_path, debug)
+        if num_shards > 1:
+            # Listed rather than a range: `select` rejects an empty range at the end of the dataset
+            ds = ds.select(list(shard_rows(len(ds), shard_index, num_shards)))
+
+        if cascade:
+            process = async_process_dataset_cascade
+        elif batch:
+            process = async_process_dataset_batched
+        else:
+            process = async_process_dataset
+        if len(ds) == 0:
+            # A shard is empty when there are more shards than rows
+            open(shard_path, "w").close()
+        elif dedup:
+            submission_ds = asyncio.run(async_process_deduplicated(ds, process))
+        else:
+            submission_ds = asyncio.run(process(ds))
     end_time = perf_counter()
 
     minutes = int((end_time - start_time) // 60)
     seconds = int((end_time - start_time) % 60)
     print(f"Time taken: {minutes}:{seconds:02d}")
 
-    submission_ds.to_json(output_path, orient="records", lines=True)
+    if submission_ds is not None:
+        submission_ds.to_json(shard_path, orient="records", lines=True)
 
-    accuracy, ratio_valid = calculate_accuracy(output_path)
-    print(f"Accuracy: {accuracy}")
-    print(f"Ratio valid judgements: {ratio_valid}")
+    stats = collect_run_stats(end_time - start_time)
+    if num_shards > 1:
+        # Accuracy and the summary are computed once, after the shards are merged
+        with open(shard_stats_path(output_path, shard_index, num_shards), "w", encoding="utf-8") as f:
+            json.dump(stats, f)
+        return
+    print_run_summary(stats, output_path, cascade=cascade, dedup=dedup)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", action="store_true", default=False)
+    parser.add_argument("--batch", action="store_true", default=False)
+    parser.add_argument("--cascade", action="store_true", default=False)
+    parser.add_argument("--stream", action="store_true", default=False, help="Read lazily and append verdicts as they complete")
+    parser.add_argument("--resume", action="store_true", default=False, help="Stream, skipping ids already judged in the output")
+    parser.add_argument("--dedup", action="store_true", default=False, help="Judge duplicate and near-duplicate rows once")
+    parser.add_argument("--trace_path", type=str, default=None, help="Append one JSON record per API call to this file")
+    parser.add_argument("--metrics_port", type=int, default=None, help="Serve Prometheus metrics on this port")
+    parser.add_argument("--num_shards", type=int, default=1, help="Split the dataset into this many contiguous shards")
+    parser.add_argument("--shard_index", type=int, default=0, help="Shard judged by this process")
+    parser.add_argument("--workers", type=int, default=1, help="Judge with this many local shard processes and merge")
+    parser.add_argument("--merge", action="store_true", default=False, help="Only merge the outputs of --num_shards shards")
     parser.add_argument("--dataset_path", type=str, required=False, default="data/dev.jsonl")
     parser.add_argument("--output_path", type=str, required=False, default="./dev_ds.jsonl")
     args = parser.parse_args()
+    if args.batch and (args.stream or args.resume):
+        parser.error("--batch is not supported together with --stream/--resume")
+    if (args.num_shards > 1 or args.workers > 1) and (args.stream or args.resume):
+        parser.error("sharding is not supported together with --stream/--resume")
+    if not 0 <= args.shard_index < args.num_shards:
+        parser.error("--shard_index must be in [0, --num_shards)")
+
+    if args.workers > 1:
+        run_workers(args)
+        sys.exit()
+    if args.merge:
+        merge_and_report(
+            args.dataset_path,
+            args.output_path,
+            args.num_shards,
+            debug=args.debug,
+            cascade=args.cascade,
+            dedup=args.dedup,
+        )
+        sys.exit()
 
-    main(dataset_path=args.dataset_path, output_path=args.output_path, debug=args.debug)
+    main(
+        dataset_path=args.dataset_path,
+        output_path=args.output_path,
+        debug=args.debug,
+        batch=args.batch,
+        cascade=args.cascade,
+        stream=args.stream,
+        resume=args.resume,
+        trace_path=args.trace_path,
+        metrics_port=args.metrics_port,
+        dedup=args.dedup,
+        num_shards=args.num_shards,
+        shard_index=args.shard_index,
+    )
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# main.py builds its OpenAI client and verdict cache at import time
+os.environ.setdefault("OPENROUTER_API_KEY", "test")
+os.environ["JUDGE_CACHE_PATH"] = ""
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,227 @@
+import asyncio
+import re
+import sqlite3
+import time
+from types import SimpleNamespace
+
+import main
+
+
+def _response(content: str):
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+        usage=None,
+    )
+
+
+def test_parse_batch_judgment_rejects_indices_beyond_item_size():
+    assert main.parse_batch_judgment("[3, 3]", [2, 4]) == [-1, 3]
+    assert main.parse_batch_judgment("[1, \"2\", true]", [4, 4, 4]) == [1, 2, -1]
+    assert main.parse_batch_judgment("[0]", [4, 4]) == [-1, -1]
+
+
+def test_batch_remaps_collapsed_completions(monkeypatch):
+    requests = []
+
+    async def fake_create(messages, input_tokens, record, **params):
+        content = messages[-1]["content"]
+        requests.append(content)
+        if "independent items" in content:
+            return _response("[3, 3]")
+        # Per-item fallback: pick the last completion shown
+        return _response(re.findall(r"^\[(\d)\]", content, re.M)[-1])
+
+    monkeypatch.setattr(main, "_create_with_retries", fake_create)
+    items = [
+        {"prompt": "p1", "completions": ["a", "a", "b", "b"]},
+        {"prompt": "p2", "completions": ["x", "y", "z", "w"]},
+    ]
+
+    results = asyncio.run(main.judge_completions_batch(items))
+
+    # Item 1 collapses to ["a", "b"], so 3 is out of range and falls back to a
+    # single call whose answer 1 ("b") maps back to original index 2
+    assert results == [2, 3]
+    assert len(requests) == 2
+
+
+def test_scheduler_admits_parked_callers_in_order():
+    async def scenario():
+        scheduler = main.AdaptiveScheduler(1, 1, 1, 0)
+        order = []
+
+        async def call(name):
+            await scheduler.acquire(0)
+            order.append(name)
+            await asyncio.sleep(0)
+            scheduler.release(0.01)
+
+        await asyncio.gather(*(call(i) for i in range(5)))
+        return order, scheduler.in_flight
+
+    assert asyncio.run(scenario()) == ([0, 1, 2, 3, 4], 0)
+
+
+def test_scheduler_wakes_parked_callers_when_pause_expires():
+    async def scenario():
+        scheduler = main.AdaptiveScheduler(2, 1, 2, 0)
+        await scheduler.acquire(0)
+        scheduler.release(0.01, throttled=True, retry_after=0.1)
+        start = time.monotonic()
+        await asyncio.wait_for(scheduler.acquire(0), timeout=1.0)
+        return time.monotonic() - start
+
+    assert 0.09 <= asyncio.run(scenario()) < 0.5
+
+
+def test_scheduler_cancelled_waiter_does_not_block_queue():
+    async def scenario():
+        scheduler = main.AdaptiveScheduler(1, 1, 1, 0)
+        await scheduler.acquire(0)
+        cancelled = asyncio.ensure_future(scheduler.acquire(0))
+        waiting = asyncio.ensure_future(scheduler.acquire(0))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        scheduler.release(0.01)
+        await asyncio.wait_for(waiting, timeout=1.0)
+        return scheduler.in_flight
+
+    assert asyncio.run(scenario()) == 1
+
+
+def test_batch_reuses_per_item_verdicts_and_batch_prompt(tmp_path, monkeypatch):
+    systems = []
+
+    async def fake_create(messages, input_tokens, record, **params):
+        systems.append(messages[0]["content"])
+        if "independent items" in messages[-1]["content"]:
+            return _response("[2, 0]")
+        return _response("1")
+
+    monkeypatch.setattr(main, "_create_with_retries", fake_create)
+    monkeypatch.setattr(main, "verdict_cache", main.VerdictCache(str(tmp_path / "cache.sqlite"), 100, 30))
+    items = [{"prompt": f"p{i}", "completions": ["a", "b", "c", "d"]} for i in range(3)]
+
+    assert asyncio.run(main.judge_completions(items[0]["prompt"], items[0]["completions"])) == 1
+    assert asyncio.run(main.judge_completions_batch(items)) == [1, 2, 0]
+
+    # Only items 1 and 2 were sent, in one batch with its own JSON-array prefix
+    assert systems[1:] == [main.BATCH_PROMPT_PREFIXES[-1]]
+    assert "JSON array" in systems[1] and "Final answer: " not in systems[1]
+
+
+def test_collapsed_item_states_its_option_count(monkeypatch):
+    prompts = []
+
+    async def fake_create(messages, input_tokens, record, **params):
+        prompts.append(messages[-1]["content"])
+        return _response("2")
+
+    monkeypatch.setattr(main, "_create_with_retries", fake_create)
+
+    assert asyncio.run(main.judge_completions("p", ["a", "b", "b", "c"])) == 3
+    assert "This item has 3 completions" in prompts[0]
+    assert "from 0 to 2" in prompts[0]
+    # Full items keep the original prompt
+    assert "This item has" not in main.render_item("p", ["a", "b", "c", "d"])
+
+
+def test_cache_prefers_first_key_and_stores_probabilities(tmp_path):
+    cache = main.VerdictCache(str(tmp_path / "cache.sqlite"), 100, 30)
+    cache.put("single", 1)
+    cache.put("batched", 2)
+    cache.put("logprobs", 0, [0.75, 0.25])
+
+    assert cache.get("missing", "single") == 1
+    assert cache.get("batched", "single") == 2
+    assert cache.get_probabilities("logprobs") == [0.75, 0.25]
+    # Plain verdicts have no distribution
+    assert cache.get_probabilities("single") is None
+    assert cache.stats() == {"hits": 3, "misses": 1, "errors": 0}
+
+
+def test_cache_upgrades_old_schema(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE verdicts (key TEXT PRIMARY KEY, judged_index INTEGER NOT NULL, "
+        "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+    )
+    conn.execute("INSERT INTO verdicts VALUES ('old', 3, ?, ?)", (time.time(), time.time()))
+    conn.commit()
+    conn.close()
+
+    cache = main.VerdictCache(path, 100, 30)
+    cache.put("new", 1, [0.0, 1.0])
+
+    assert cache.get("old") == 3
+    assert cache.get_probabilities("new") == [0.0, 1.0]
+
+
+def test_locked_cache_is_a_quick_miss(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    main.VerdictCache(path, 100, 30).put("key", 1)
+    # Another worker holding an exclusive lock
+    other = sqlite3.connect(path)
+    other.execute("BEGIN EXCLUSIVE")
+    cache = main.VerdictCache(path, 100, 30, timeout=0.05)
+
+    start = time.monotonic()
+    assert cache.get("key") is None
+    cache.put("key", 2)
+    assert time.monotonic() - start < 1.0
+    assert cache.stats()["errors"] == 2
+
+    other.rollback()
+    assert cache.get("key") == 1
+
+
+def test_cascade_reuses_cached_distributions(tmp_path, monkeypatch):
+    calls = []
+
+    async def fake_create(messages, input_tokens, record, **params):
+        calls.append(params)
+        top = [SimpleNamespace(token="1", logprob=-0.05), SimpleNamespace(token="0", logprob=-3.0)]
+        return SimpleNamespace(
+            choices=[SimpleNamespace(
+                message=SimpleNamespace(content="1"),
+                logprobs=SimpleNamespace(content=[SimpleNamespace(top_logprobs=top)]),
+            )],
+            usage=None,
+        )
+
+    monkeypatch.setattr(main, "_create_with_retries", fake_create)
+    monkeypatch.setattr(main, "verdict_cache", main.VerdictCache(str(tmp_path / "cache.sqlite"), 100, 30))
+
+    first = asyncio.run(main.judge_completions_cascade("p", ["a", "b", "c", "d"]))
+    second = asyncio.run(main.judge_completions_cascade("p", ["a", "b", "c", "d"]))
+
+    assert first == second
+    assert first["judged_index"] == 1 and first["tier"] == 1
+    assert len(calls) == 1
+
+
+def test_missing_usage_is_counted_not_estimated(monkeypatch):
+    async def create(**kwargs):
+        return _response("1")
+
+    monkeypatch.setattr(main, "client", SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create))))
+    monkeypatch.setattr(main, "scheduler", main.AdaptiveScheduler(1, 1, 1, 0))
+    monkeypatch.setattr(main, "telemetry", main.Telemetry())
+    record = main.telemetry.new_record("judge")
+
+    asyncio.run(main._create_with_retries([], 123, record, max_tokens=1))
+    main.telemetry.emit(record)
+
+    assert record["prompt_tokens"] is None and record["usage_missing"]
+    summary = main.telemetry.summary(1.0)
+    assert summary["prompt_tokens"] == 0 and summary["usage_missing"] == 1
+
+
+def test_logprobs_without_alternatives_fall_back_to_one_hot():
+    response = SimpleNamespace(choices=[SimpleNamespace(
+        message=SimpleNamespace(content="2"),
+        logprobs=SimpleNamespace(content=[SimpleNamespace(token="2", logprob=-0.1, top_logprobs=None)]),
+    )])
+
+    assert main.parse_probabilities(response, 4) == ([0.0, 0.0, 1.0, 0.0], False)
@@ -0,0 +1,88 @@
+import asyncio
+import json
+from pathlib import Path
+
+import main
+import run_submission
+
+
+def _write_jsonl(path, rows, trailing_newline=True):
+    text = "\n".join(json.dumps(row) for row in rows)
+    path.write_text(text + ("\n" if trailing_newline else ""), encoding="utf-8")
+
+
+def test_resume_after_crash_without_trailing_newline(tmp_path, monkeypatch):
+    async def fake_judge(prompt, completions):
+        return 1
+
+    monkeypatch.setattr(main, "judge_completions", fake_judge)
+    rows = [{"id": str(i), "prompt": f"p{i}", "completions": ["a", "b"]} for i in range(4)]
+    dataset_path = tmp_path / "data.jsonl"
+    output_path = tmp_path / "out.jsonl"
+    _write_jsonl(dataset_path, rows)
+    # A crash left the last valid row without its newline
+    _write_jsonl(output_path, [{**row, "judged_index": 0} for row in rows[:2]], trailing_newline=False)
+
+    judged = asyncio.run(run_submission.async_process_stream(str(dataset_path), str(output_path), resume=True))
+
+    assert judged == 2
+    lines = output_path.read_text(encoding="utf-8").splitlines()
+    assert [json.loads(line)["judged_index"] for line in lines] == [0, 0, 1, 1]
+
+
+def test_resume_redoes_invalid_and_truncated_rows(tmp_path):
+    output_path = tmp_path / "out.jsonl"
+    output_path.write_text(
+        json.dumps({"id": "0", "judged_index": 2}) + "\n"
+        + json.dumps({"id": "1", "judged_index": -1}) + "\n"
+        + '{"id": "2", "judged_',
+        encoding="utf-8",
+    )
+
+    assert run_submission.load_completed_ids(str(output_path)) == {"0"}
+    assert output_path.read_text(encoding="utf-8") == json.dumps({"id": "0", "judged_index": 2}) + "\n"
+
+
+def test_shards_merge_back_in_dataset_order(tmp_path):
+    rows = [{"id": str(i), "prompt": f"p{i}", "completions": ["a", "b"]} for i in range(3)]
+    dataset_path = tmp_path / "data.jsonl"
+    output_path = tmp_path / "out.jsonl"
+    _write_jsonl(dataset_path, rows)
+    num_shards = 5
+
+    for shard_index in range(num_shards):
+        shard = [rows[i] for i in run_submission.shard_rows(len(rows), shard_index, num_shards)]
+        shard_path = run_submission.shard_output_path(str(output_path), shard_index, num_shards)
+        if shard:
+            _write_jsonl(Path(shard_path), [{**row, "judged_index": int(row["id"])} for row in shard])
+        else:
+            # More shards than rows leaves some shards empty
+            Path(shard_path).write_text("", encoding="utf-8")
+
+    run_submission.merge_shards(str(dataset_path), str(output_path), num_shards)
+
+    merged = [json.loads(line) for line in output_path.read_text(encoding="utf-8").splitlines()]
+    assert [row["id"] for row in merged] == ["0", "1", "2"]
+    assert [row["judged_index"] for row in merged] == [0, 1, 2]
+
+
+def test_stream_dedup_judges_exact_duplicates_once(tmp_path, monkeypatch):
+    calls = []
+
+    async def fake_judge(prompt, completions):
+        calls.append(prompt)
+        await asyncio.sleep(0)
+        return 2
+
+    monkeypatch.setattr(main, "judge_completions", fake_judge)
+    rows = [{"id": str(i), "prompt": f"p{i % 2}", "completions": ["a", "b", "c"]} for i in range(6)]
+    dataset_path = tmp_path / "data.jsonl"
+    output_path = tmp_path / "out.jsonl"
+    _write_jsonl(dataset_path, rows)
+
+    judged = asyncio.run(run_submission.async_process_stream(str(dataset_path), str(output_path), dedup=True))
+
+    assert judged == 6
+    assert sorted(calls) == ["p0", "p1"]
+    lines = output_path.read_text(encoding="utf-8").splitlines()
+    assert [json.loads(line)["judged_index"] for line in lines] == [2] * 6